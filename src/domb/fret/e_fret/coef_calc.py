@@ -7,13 +7,20 @@ Based on Zal and Gascoigne, 2004, doi: 10.1529/biophysj.103.022087
 
 """
 
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property
+
 import numpy as np
-from numpy import ma
 import pandas as pd
 
 import matplotlib.pyplot as plt
+from matplotlib import colors
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+from mpl_toolkits.axes_grid1 import ImageGrid
 import matplotlib.patheffects as PathEffects
+from matplotlib.figure import Figure
 
 from sklearn.linear_model import LinearRegression
 
@@ -23,17 +30,179 @@ from skimage import measure
 from skimage import io
 
 from scipy import stats
+from scipy import sparse
 from scipy import ndimage as ndi
 
 from ...utils import masking
 
 
+def _bc_p_m(x, buf=None):
+    """ Frame-wise background subtraction by 1st percentile of frame intensity,
+    percentiles for all frames are calculated in one call.
+
+    Frames are the last two axes of `x`, e.g. [t,x,y] or [ch,t,x,y],
+    returns C-contiguous float32 array.
+
+    `buf` - optional flat scratch array of `x` dtype with at least `x.size` elements,
+    reused for percentile selection instead of allocating a copy of `x`.
+
+    """
+    frame_size = x.shape[-2]*x.shape[-1]
+    if buf is not None and buf.dtype == x.dtype and buf.size >= x.size:
+        frames = buf[:x.size].reshape(-1, frame_size)
+        np.copyto(frames.reshape(x.shape), x)
+    else:
+        frames = x.reshape(-1, frame_size)
+        # reshape of non-contiguous stack is already a copy
+        if np.shares_memory(frames, x):
+            frames = frames.copy()
+    # 1st percentile as k-th smallest value (percentile method 'lower'), selection instead of full sort
+    k = int(0.01 * (frame_size-1))
+    frames.partition(k, axis=1)
+    p = frames[:,k]
+    p = p.reshape(x.shape[:-2] + (1,1))
+    bc_x = np.subtract(x, p, dtype=np.float32, order='C')
+    np.maximum(bc_x, 0, out=bc_x)
+    return bc_x
+
+
+def _label_keep_px(label, n_labels, bad_rois=[]):
+    """ Pixels of label elements not in `bad_rois`, grouped by label number.
+
+    Returns flattened frame indexes and label number of each pixel, both allocated
+    once with size from label elements pixels count.
+
+    """
+    flat_label = label.ravel()
+    label_order = np.argsort(flat_label, kind='stable')
+    keep = np.setdiff1d(np.arange(1, n_labels+1), bad_rois)
+    counts = np.bincount(flat_label, minlength=n_labels+1)
+    # labels are sorted, kept label run starts after all preceding pixels
+    starts = np.cumsum(counts)[keep-1]
+    keep_px = np.empty(counts[keep].sum(), dtype=label_order.dtype)
+    keep_label = np.repeat(keep.astype(label.dtype), counts[keep])
+    arr_len = 0
+    for start, count in zip(starts, counts[keep]):
+        keep_px[arr_len:arr_len+count] = label_order[start:start+count]
+        arr_len += count
+    return keep_px, keep_label
+
+
+def _label_px(label):
+    """ Labeled pixels indexes in flattened frame and their label number - 1.
+
+    """
+    flat_label = label.ravel()
+    label_px = np.flatnonzero(flat_label)
+    return label_px, flat_label[label_px] - 1
+
+
+def _px_gather(img, label_px):
+    """ Selected pixels of [...,x,y] stack, returns ndarray [...,px].
+
+    """
+    return img.reshape(img.shape[:-2] + (-1,))[...,label_px]
+
+
+def _label_indicator(label_idx, n_labels):
+    """ Sparse (CSR) indicator matrix [px,label_num-1] of labeled pixels,
+    label sums of pixels stack [...,px] as one sparse matrix product.
+
+    """
+    return sparse.csr_matrix((np.ones(label_idx.size), (np.arange(label_idx.size), label_idx)),
+                             shape=(label_idx.size, n_labels))
+
+
+def _label_mean_sd(px_stack, label_ind, calc_sd=True, ignore_nan=True):
+    """ Mean and standard deviation of labeled pixels stack [...,px] for each label element,
+    non-finite pixels are ignored, or propagate to their label mean if `ignore_nan=False`.
+    Counts, sums and sums of squares of all rows are calculated
+    in float64 by sparse matrix products with label indicator matrix.
+
+    Returns two ndarrays [...,label_num-1], SD is None if `calc_sd=False`
+
+    """
+    px_rows = px_stack.reshape(-1, px_stack.shape[-1])
+    px_finite = np.isfinite(px_rows) if ignore_nan else None
+    px_val = px_rows.astype(np.float64)
+    if px_finite is None or px_finite.all():
+        px_count = np.asarray(label_ind.sum(axis=0))
+    else:
+        px_val[~px_finite] = 0
+        px_count = px_finite.astype(np.float64) @ label_ind
+    out_shape = px_stack.shape[:-1] + (label_ind.shape[1],)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        label_mean = (px_val @ label_ind) / px_count
+        if not calc_sd:
+            return label_mean.reshape(out_shape), None
+        # Var = E[X^2] - E[X]^2, clipped at zero against rounding
+        np.square(px_val, out=px_val)
+        label_sd = np.sqrt(np.maximum((px_val @ label_ind) / px_count - label_mean**2, 0))
+    return label_mean.reshape(out_shape), label_sd.reshape(out_shape)
+
+
+def _label_color_kw(n_labels):
+    """ Scatter colormap and norm kwargs with exactly one color for each label number 1..n_labels,
+    tab20 colors up to 20 labels, evenly sampled turbo colormap for more.
+
+    """
+    if n_labels <= 20:
+        label_colors = plt.get_cmap('tab20').colors[:max(n_labels, 1)]
+    else:
+        label_colors = plt.get_cmap('turbo')(np.linspace(0, 1, n_labels))
+    label_cmap = colors.ListedColormap(label_colors)
+    label_norm = colors.BoundaryNorm(np.arange(0.5, label_cmap.N + 1), label_cmap.N)
+    return {'cmap':label_cmap, 'norm':label_norm}
+
+
+def _ch_mean_imgs(reg):
+    """ Stack [ch,x,y] of DD, DA, AD and AA mean images of registration.
+
+    Mean images are `cached_property` of the registration class, calculated on first access.
+    The cache has to be dropped from instance `__dict__`
+    (e.g. `reg.__dict__.pop('DD_mean_img', None)`) if the source stack changes.
+
+    """
+    return np.stack([reg.DD_mean_img, reg.DA_mean_img, reg.AD_mean_img, reg.AA_mean_img])
+
+
+def _lin_fit(x, y):
+    """ Least-squares linear fit from first and second order sums of float32 data,
+    accumulated in float64. Same values as `scipy.stats.linregress`.
+
+    Returns slope, intercept, r, p_slope, std_err_slope, std_err_intercept
+
+    """
+    x = np.asarray(x, dtype=np.float32)
+    y = np.asarray(y, dtype=np.float32)
+    n = x.size
+
+    x_mean = x.sum(dtype=np.float64) / n
+    y_mean = y.sum(dtype=np.float64) / n
+    ssxm = np.einsum('i,i->', x, x, dtype=np.float64) / n - x_mean**2
+    ssym = np.einsum('i,i->', y, y, dtype=np.float64) / n - y_mean**2
+    ssxym = np.einsum('i,i->', x, y, dtype=np.float64) / n - x_mean*y_mean
+
+    slope = ssxym / ssxm
+    intercept = y_mean - slope*x_mean
+    r = np.clip(ssxym / np.sqrt(ssxm*ssym), -1.0, 1.0)
+
+    df = n - 2
+    t = r * np.sqrt(df / ((1.0 - r + 1e-20)*(1.0 + r + 1e-20)))
+    p_slope = 2*stats.t.sf(np.abs(t), df)
+    std_err_slope = np.sqrt((1 - r**2) * ssym / ssxm / df)
+    std_err_intercept = std_err_slope * np.sqrt(ssxm + x_mean**2)
+
+    return slope, intercept, r, p_slope, std_err_slope, std_err_intercept
+
+
 # crosstalk estimation
 class CrossReg():
     """ Class for one 3-cube FRET method crosstalk calibration registration
 
     """
-    def __init__(self, img, img_name, exp_list, img_type):
+    def __init__(self, img, img_name, exp_list, img_type, bc_buf=None):
         self.img_name = img_name
         self.img_type = img_type
         self.img_raw = img
@@ -41,17 +210,15 @@ class CrossReg():
         self.D_exp = exp_list[0]
         self.A_exp = exp_list[1]
 
-        bc_p_m = lambda x: np.array([f - np.percentile(f,1) for f in x]).clip(min=0).astype(np.uint16)
+        # float32 channels stack [ch,t,x,y], channel images are views of it
+        self.channels = _bc_p_m(np.moveaxis(self.img_raw, -1, 0), buf=bc_buf)
+        self.DD_img = self.channels[0]  # CFP-435  DD
+        self.DA_img = self.channels[1]  # YFP-435  DA
+        self.AD_img = self.channels[2]  # CFP-505  AD
+        self.AA_img = self.channels[3]  # YFP-505  AA
 
-        self.DD_img = bc_p_m(self.img_raw[:,:,:,0])  # CFP-435  DD
-        self.DA_img = bc_p_m(self.img_raw[:,:,:,1])  # YFP-435  DA
-        self.AD_img = bc_p_m(self.img_raw[:,:,:,2])  # CFP-505  AD
-        self.AA_img = bc_p_m(self.img_raw[:,:,:,3])  # YFP-505  AA
-
-        self.DD_mean_img = np.mean(self.DD_img, axis=0)
-        self.DA_mean_img = np.mean(self.DA_img, axis=0)
-        self.AD_mean_img = np.mean(self.AD_img, axis=0)
-        self.AA_mean_img = np.mean(self.AA_img, axis=0)
+        # channels mean images are cached properties, only the one used for mask is calculated here
+        self._profiles = np.mean(self.channels, axis=(2,3))  # [ch,t]
 
         if self.img_type == 'A':
             raw_mask = self.AA_mean_img > filters.threshold_otsu(self.AA_mean_img)
@@ -61,15 +228,41 @@ class CrossReg():
         self.mask = morphology.closing(raw_mask, footprint=morphology.disk(10))
         self.mask = morphology.erosion(self.mask, footprint=morphology.disk(10))
         self.label = measure.label(self.mask)
+        self.n_labels = int(np.max(self.label))
 
 
-    def cross_fit_px(self, frame_num=0, mode='a', bad_rois=[]):
-        pure_frame_arr = np.asarray([])
-        cross_frame_arr = np.asarray([])
-        
-        fig, ax = plt.subplots(layout="constrained", figsize=(10, 4))
-        fig.suptitle(f'{self.img_name}: {mode} estimation pixel-wise (frame {frame_num})')
-        
+    # mean images of background subtracted channels, cached (see _ch_mean_imgs)
+    @cached_property
+    def DD_mean_img(self):
+        return np.mean(self.DD_img, axis=0, dtype=np.float32)
+
+    @cached_property
+    def DA_mean_img(self):
+        return np.mean(self.DA_img, axis=0, dtype=np.float32)
+
+    @cached_property
+    def AD_mean_img(self):
+        return np.mean(self.AD_img, axis=0, dtype=np.float32)
+
+    @cached_property
+    def AA_mean_img(self):
+        return np.mean(self.AA_img, axis=0, dtype=np.float32)
+
+
+    def cross_calc_px(self, frame_num=0, mode='a', bad_rois=[]):
+        """ Pixel-wise crosstalk coefficient estimation for selected frame,
+        pixels with zero intensity in any channel and `bad_rois` labels are skipped.
+
+        Returns
+        -------
+        fit_dict: dict
+            pure (`x`) and cross (`y`) channel intensity of fitted pixels,
+            label number of each pixel (`label`) and linear fit results
+
+        """
+        if self.channels is None:
+            raise ValueError('Channels stacks are dropped (keep_stacks=False), pixel-wise estimation is unavailable!')
+
         if mode == 'a' and self.img_type == 'A':
             pure_frame = self.AA_img[frame_num] 
             cross_frame = self.DA_img[frame_num] 
@@ -86,39 +279,41 @@ class CrossReg():
             raise ValueError('Inconsidtent image type and coeficient!')
 
 
-        for label_num in range(1, np.max(self.label)+1):
-            label_mask = self.label == label_num
+        keep_px, keep_label = _label_keep_px(self.label, self.n_labels, bad_rois)
+        pure_frame_arr = pure_frame.ravel()[keep_px]
+        cross_frame_arr = cross_frame.ravel()[keep_px]
 
-            pure_i = ma.masked_where(label_mask, pure_frame).compressed()
-            cross_i = ma.masked_where(label_mask, cross_frame).compressed()
+        non_zeros = (pure_frame_arr > 0) & (cross_frame_arr > 0)
+        pure_frame_arr, cross_frame_arr = pure_frame_arr[non_zeros], cross_frame_arr[non_zeros]
+        label_arr = keep_label[non_zeros]
 
-            all_zeros = np.array([any(t) for t in zip(pure_i<=0, cross_i<=0)], dtype=np.bool_)
-            pure_i, cross_i = pure_i[~all_zeros], cross_i[~all_zeros]
+        slope, intercept, r, p_slope, std_err_slope, std_err_intercept = _lin_fit(pure_frame_arr, cross_frame_arr)
 
-            if label_num in bad_rois:
-                continue
-            else:
-                ax.scatter(x=pure_i,y=cross_i, label=label_num,
-                           alpha=.1, s=0.075)
+        p_t_calc = lambda m,s,l: 2*stats.t.sf(abs(m/s), (1.0*l - 2))
+        p_intercept = p_t_calc(intercept, std_err_intercept, len(pure_frame_arr))
 
-                pure_frame_arr = np.concatenate((pure_frame_arr, pure_i))
-                cross_frame_arr = np.concatenate((cross_frame_arr, cross_i))
+        return {'x':pure_frame_arr, 'y':cross_frame_arr, 'label':label_arr,
+                'slope':slope, 'std_err_slope':std_err_slope, 'p_slope':p_slope,
+                'intercept':intercept, 'std_err_intercept':std_err_intercept, 'p_intercept':p_intercept,
+                'r':r}
 
-        # slope, intercept, r, p_slope, std_err = stats.linregress(DD_delta_arr, Fc_delta_arr)
 
-        lin_mod_data = stats.linregress(pure_frame_arr, cross_frame_arr)
-        slope, p_slope, std_err_slope = lin_mod_data.slope, lin_mod_data.pvalue, lin_mod_data.stderr
-        intercept, std_err_intercept = lin_mod_data.intercept, lin_mod_data.intercept_stderr
-        r = lin_mod_data.rvalue
+    def cross_fit_px(self, frame_num=0, mode='a', bad_rois=[]):
+        fit_dict = self.cross_calc_px(frame_num=frame_num, mode=mode, bad_rois=bad_rois)
+        slope, intercept = fit_dict['slope'], fit_dict['intercept']
 
-        p_t_calc = lambda m,s,l: 2*stats.t.sf(abs(m/s), (1.0*l - 2))
-        p_intercept = p_t_calc(intercept, std_err_intercept, len(pure_frame_arr))
+        fig, ax = plt.subplots(layout="constrained", figsize=(10, 4))
+        fig.suptitle(f'{self.img_name}: {mode} estimation pixel-wise (frame {frame_num})')
 
-        lin_mod = lambda x: slope*x + intercept
+        # all labels in one scatter, colored by label number
+        ax.scatter(x=fit_dict['x'], y=fit_dict['y'], c=fit_dict['label'],
+                   alpha=.1, s=0.075, **_label_color_kw(self.n_labels))
 
-        ax.plot(pure_frame_arr, list(map(lin_mod, pure_frame_arr)),
+        # straight line, end points only
+        line_x = np.array([np.min(fit_dict['x']), np.max(fit_dict['x'])], dtype=float)
+        ax.plot(line_x, slope*line_x + intercept,
                  color='k', linestyle='--')
-        ax.set_title(f'{mode}={round(slope,3)}+/-{round(std_err_slope,3)} (p={p_slope}), inter.={round(intercept,1)}+/-{round(std_err_slope,3)} (p={p_intercept}), R^2={round(r,4)}')
+        ax.set_title(f'{mode}={round(slope,3)}+/-{round(fit_dict["std_err_slope"],3)} (p={fit_dict["p_slope"]}), inter.={round(intercept,1)}+/-{round(fit_dict["std_err_intercept"],3)} (p={fit_dict["p_intercept"]}), R^2={round(fit_dict["r"],4)}')
         ax.set_xlabel('I, a.u.')
         ax.set_ylabel('I, a.u.')
         plt.show()
@@ -126,12 +321,17 @@ class CrossReg():
 
 
     def cross_calc(self):
+        # labeled pixels of all channels are gathered once,
+        # ratios are calculated for them only and reduced for all labels and frames in one call
+        label_px, label_idx = _label_px(self.label)
+        label_ind = _label_indicator(label_idx, self.n_labels)
+        DD_px, DA_px, AD_px, AA_px = _px_gather(self.channels, label_px)
+
         if self.img_type == 'A':
-            _, self.a_prof_arr = masking.label_prof_arr(input_label=self.label,
-                                                        input_img_series=self.DA_img / self.AA_img)
+            ratio_label = _label_mean_sd(np.stack([DA_px, AD_px]) / AA_px, label_ind,
+                                         calc_sd=False, ignore_nan=False)[0]
+            self.a_prof_arr, self.b_prof_arr = np.swapaxes(ratio_label, 1, 2)  # [label_num-1, t]
             self.a_prof_mean = np.mean(self.a_prof_arr, axis=0)
-            _, self.b_prof_arr = masking.label_prof_arr(input_label=self.label,
-                                                        input_img_series=self.AD_img / self.AA_img)
             self.b_prof_mean = np.mean(self.b_prof_arr, axis=0)
             # self.a_prof_mean = np.asarray([np.mean(self.DA_img[i] / self.AA_img[i]) for i in range(0, self.img_raw.shape[0])])
             # self.b_prof_mean = np.asarray([np.mean(self.AD_img[i] / self.AA_img[i]) for i in range(0, self.img_raw.shape[0])])
@@ -167,11 +367,10 @@ class CrossReg():
                                           'sd':[self.a_sd, self.b_sd]})
 
         elif self.img_type == 'D':
-            _, self.c_prof_arr = masking.label_prof_arr(input_label=self.label,
-                                                        input_img_series=self.AA_img / self.DD_img)
+            ratio_label = _label_mean_sd(np.stack([AA_px, DA_px]) / DD_px, label_ind,
+                                         calc_sd=False, ignore_nan=False)[0]
+            self.c_prof_arr, self.d_prof_arr = np.swapaxes(ratio_label, 1, 2)  # [label_num-1, t]
             self.c_prof_mean = np.mean(self.c_prof_arr, axis=0)
-            _, self.d_prof_arr = masking.label_prof_arr(input_label=self.label,
-                                                        input_img_series=self.DA_img / self.DD_img)
             self.d_prof_mean = np.mean(self.d_prof_arr, axis=0)
 
             # self.c_prof_mean = np.asarray([np.mean(self.AA_img[i] / self.DD_img[i]) \
@@ -233,13 +432,13 @@ class CrossReg():
         plt.figure(figsize=(8,4))
 
         ax0 = plt.subplot()
-        ax0.plot(np.mean(self.DD_img, axis=(1,2)),
+        ax0.plot(self._profiles[0],
                  label='Ch 0 (CFP-435)', color='r')
-        ax0.plot(np.mean(self.DA_img, axis=(1,2)),
+        ax0.plot(self._profiles[1],
                  label='Ch 1 (YFP-435)', color='g')
-        ax0.plot(np.mean(self.AD_img, axis=(1,2)),
+        ax0.plot(self._profiles[2],
                  label='Ch 2 (CFP-505)', color='y')
-        ax0.plot(np.mean(self.AA_img, axis=(1,2)),
+        ax0.plot(self._profiles[3],
                  label='Ch 3 (YFP-505)', color='b')
         ax0.legend()
 
@@ -249,50 +448,82 @@ class CrossReg():
 
 
     def ch_pic(self):
-        int_min = np.min(self.img_raw)
-        int_max = np.max(self.img_raw)
+        # shared color scale from the plotted mean images, not from full raw stack
+        mean_imgs = _ch_mean_imgs(self)
+        int_min, int_max = np.min(mean_imgs), np.max(mean_imgs)
+
+        fig = plt.figure(figsize=(10,10))
+        # 2x2 grid of channels mean images with one shared colorbar
+        grid = ImageGrid(fig, 111, nrows_ncols=(2,2), axes_pad=0.4,
+                         cbar_mode='single', cbar_location='right', cbar_size='3%', cbar_pad=0.1)
+        ch_titles = ['DD (Ch.0)', 'DA (Ch.1)', 'AD (Ch.2)', 'AA (Ch.3)']
+        for ax, ch_title, ch_mean_img in zip(grid, ch_titles, mean_imgs):
+            ax.set_title(ch_title)
+            ch_img = ax.imshow(ch_mean_img, cmap='jet', interpolation='nearest',
+                               vmin=int_min, vmax=int_max)
+            ax.axis('off')
+        grid.cbar_axes[0].colorbar(ch_img)
 
-        plt.figure(figsize=(10,10))
+        plt.suptitle(f'File {self.img_name}, type {self.img_type}')
+        plt.show()
 
-        ax0 = plt.subplot(221)
-        ax0.set_title('DD (Ch.0)')
-        img0 = ax0.imshow(self.DD_mean_img, cmap='jet')
-        img0.set_clim(vmin=int_min, vmax=int_max)
-        div0 = make_axes_locatable(ax0)
-        cax0 = div0.append_axes('right', size='3%', pad=0.1)
-        plt.colorbar(img0, cax=cax0)
-        ax0.axis('off')
 
-        ax1 = plt.subplot(222)
-        ax1.set_title('DA (Ch.1)')
-        img1 = ax1.imshow(self.DA_mean_img, cmap='jet')
-        img1.set_clim(vmin=int_min, vmax=int_max)
-        div1 = make_axes_locatable(ax1)
-        cax1 = div1.append_axes('right', size='3%', pad=0.1)
-        plt.colorbar(img1, cax=cax1)
-        ax1.axis('off')
-
-        ax2 = plt.subplot(223)
-        ax2.set_title('AD (Ch.2)')
-        img2 = ax2.imshow(self.AD_mean_img, cmap='jet')
-        img2.set_clim(vmin=int_min, vmax=int_max)
-        div2 = make_axes_locatable(ax2)
-        cax2 = div2.append_axes('right', size='3%', pad=0.1)
-        plt.colorbar(img2, cax=cax2)
-        ax2.axis('off')
-
-        ax3 = plt.subplot(224)
-        ax3.set_title('AA (Ch.3)')
-        img3 = ax3.imshow(self.AA_mean_img, cmap='jet')
-        img3.set_clim(vmin=int_min, vmax=int_max)
-        div3 = make_axes_locatable(ax3)
-        cax3 = div3.append_axes('right', size='3%', pad=0.1)
-        plt.colorbar(img3, cax=cax3)
-        ax3.axis('off')
+    def drop_stacks(self):
+        """ Drop raw and channels stacks to save memory, coefficients, profiles and
+        channels mean images are kept. Pixel-wise methods are unavailable afterwards.
+
+        """
+        # mean images are calculated from channels stacks, cache them before drop
+        for ch_mean_name in ('DD_mean_img', 'DA_mean_img', 'AD_mean_img', 'AA_mean_img'):
+            getattr(self, ch_mean_name)
+        self.img_raw = self.channels = None
+        self.DD_img = self.DA_img = self.AD_img = self.AA_img = None
+
+
+def _load_reg_img(name_path, trim_frame=-1):
+    """ Registration [t,x,y,ch] from TIFF, first `trim_frame` frames only if positive
+
+    """
+    img = io.imread(name_path)
+    if trim_frame > 0:
+        img = img[:trim_frame]
+    return img
+
+
+def _grow_bc_buf(bc_buf, img):
+    """ Background subtraction scratch buffer large enough for `img`,
+    reallocated only for bigger registration
+
+    """
+    if bc_buf is None or bc_buf.dtype != img.dtype or bc_buf.size < img.size:
+        bc_buf = np.empty(img.size, dtype=img.dtype)
+    return bc_buf
 
-        plt.suptitle(f'File {self.img_name}, type {self.img_type}')
-        plt.tight_layout()
-        plt.show()
+
+# per-process background subtraction scratch of process pool workers, see _cross_reg_calc
+_worker_bc_buf = None
+
+
+def _cross_reg_calc(name_path, reg_name, exp_list, img_type, trim_frame=-1, keep_stacks=True):
+    """ Load and process one crosstalk calibration registration in process pool worker,
+    module-level for pickling.
+
+    With `keep_stacks=False` registration is returned without raw and channels stacks,
+    see `CrossReg.drop_stacks`.
+
+    """
+    global _worker_bc_buf
+    img = _load_reg_img(name_path, trim_frame)
+    _worker_bc_buf = _grow_bc_buf(_worker_bc_buf, img)
+    reg = CrossReg(img=img,
+                   img_name=reg_name,
+                   exp_list=exp_list,
+                   img_type=img_type,
+                   bc_buf=_worker_bc_buf)
+    reg.cross_calc()
+    if not keep_stacks:
+        reg.drop_stacks()
+    return reg
 
 
 class CrossRegSet():
@@ -300,64 +531,79 @@ class CrossRegSet():
 
     Requires sets of (A) and (D) registrations
 
+    Registrations are loaded and processed in parallel with `n_workers` processes
+    (CPU count if None, no more than number of registrations), each worker reuses
+    own background subtraction scratch buffer. `n_workers=1` is the low-memory option:
+    registrations are processed one by one in the current process with one shared
+    scratch buffer, without worker processes and pickling of results.
+
+    With `keep_stacks=False` registrations keep coefficients, channels mean images and
+    profiles only, raw and channels stacks are dropped (pixel-wise methods are unavailable).
+
     """
-    def __init__(self, data_path, donor_reg_dict, acceptor_reg_dict, trim_frame=-1):
+    def __init__(self, data_path, donor_reg_dict, acceptor_reg_dict, trim_frame=-1,
+                 n_workers=None, keep_stacks=True):
         self.donor_reg = donor_reg_dict
         self.acceptor_reg = acceptor_reg_dict
 
+        reg_args = [(data_path + f'{reg_name}.tif', reg_name, exp_list, 'D', trim_frame)
+                    for reg_name, exp_list in self.donor_reg.items()]
+        reg_args += [(data_path + f'{reg_name}.tif', reg_name, exp_list, 'A', trim_frame)
+                     for reg_name, exp_list in self.acceptor_reg.items()]
+
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        n_workers = min(n_workers, len(reg_args))
+        if n_workers <= 1:
+            # background subtraction scratch shared by all registrations
+            bc_buf = None
+            reg_list = []
+            for name_path, reg_name, exp_list, img_type, trim_frame in reg_args:
+                img = _load_reg_img(name_path, trim_frame)
+                bc_buf = _grow_bc_buf(bc_buf, img)
+                reg = CrossReg(img=img,
+                               img_name=reg_name,
+                               exp_list=exp_list,
+                               img_type=img_type,
+                               bc_buf=bc_buf)
+                reg.cross_calc()
+                if not keep_stacks:
+                    reg.drop_stacks()
+                reg_list.append(reg)
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                reg_list = list(executor.map(_cross_reg_calc, *zip(*reg_args),
+                                             [keep_stacks] * len(reg_args)))
 
-        self.donor_reg_list = []
-        for reg_name in self.donor_reg.keys():
-            name_path = data_path + f'{reg_name}.tif'
-            self.donor_reg_list.append(CrossReg(data_path=name_path,
-                                        data_name=reg_name,
-                                        exp_list=self.donor_reg[reg_name],
-                                        data_type='D',
-                                        trim_frame=trim_frame))
-        self.acceptor_reg_list = []
-        for reg_name in self.acceptor_reg.keys():
-            name_path = data_path + f'{reg_name}.tif'
-            self.acceptor_reg_list.append(CrossReg(data_path=name_path,
-                                                   data_name=reg_name,
-                                                   exp_list=self.acceptor_reg[reg_name],
-                                                   data_type='A',
-                                                   trim_frame=trim_frame))
+        self.donor_reg_list = reg_list[:len(self.donor_reg)]
+        self.acceptor_reg_list = reg_list[len(self.donor_reg):]
 
 
     def get_abcd(self, show_pic=False):
         """ Create data frame with calculated crosstalc coeficients for each calibration registration
 
         """
+        reg_list = self.acceptor_reg_list + self.donor_reg_list
 
-        self.cross_raw_df = pd.DataFrame(columns=['ID',  # df with raw results
-                                                   'type',
-                                                   'A_exp',
-                                                   'D_exp',
-                                                   'frame',
-                                                   'coef',
-                                                   'val'])
-
-        self.cross_df = pd.DataFrame(columns=['ID',
-                                                  'type',
-                                                  'A_exp',
-                                                  'D_exp',
-                                                  'coef',
-                                                  'val',
-                                                  'sd'])
-
-        for reg in self.acceptor_reg_list + self.donor_reg_list:
-            if show_pic:
+        if show_pic:
+            for reg in reg_list:
                 reg.ch_pic()
-            reg.cross_calc()
-            self.cross_raw_df = pd.concat([self.cross_raw_df, reg.cross_raw_df], ignore_index=True)
-            self.cross_df = pd.concat([self.cross_df, reg.cross_df], ignore_index=True)
+
+        if not reg_list:
+            self.cross_raw_df = pd.DataFrame(columns=['ID', 'type', 'A_exp', 'D_exp', 'frame', 'coef', 'val'])
+            self.cross_df = pd.DataFrame(columns=['ID', 'type', 'A_exp', 'D_exp', 'coef', 'val', 'sd'])
+            return self.cross_df
+
+        # df with raw results
+        self.cross_raw_df = pd.concat([reg.cross_raw_df for reg in reg_list], ignore_index=True)
+        self.cross_df = pd.concat([reg.cross_df for reg in reg_list], ignore_index=True)
 
         return self.cross_df
     
 
 # G parameter estimation
 class GReg():
-    def __init__(self, img_name, pre_img, post_img, coef_list):
+    def __init__(self, img_name, pre_img, post_img, coef_list, store_AD=False, bc_buf=None):
         self.img_name = img_name
         self.img_raw = pre_img
         self.img_bleach = post_img
@@ -373,22 +619,7 @@ class GReg():
         self.d = coef_list[3]
 
 
-        self.DD_img = self.img_raw[:,:,:,0]  # CFP-435  DD
-        self.DA_img = self.img_raw[:,:,:,1]  # YFP-435  DA
-        self.AD_img = self.img_raw[:,:,:,2]  # CFP-505  AD
-        self.AA_img = self.img_raw[:,:,:,3]  # YFP-505  AA
-
-        self.DD_img_post = self.img_bleach[:,:,:,0]
-        self.DA_img_post = self.img_bleach[:,:,:,1]
-        self.AD_img_post = self.img_bleach[:,:,:,2]
-        self.AA_img_post = self.img_bleach[:,:,:,3]
-
-
-        self.DD_mean_img = np.mean(self.DD_img, axis=0)
-        self.DA_mean_img = np.mean(self.DA_img, axis=0)
-        self.AD_mean_img = np.mean(self.AD_img, axis=0)
-        self.AA_mean_img = np.mean(self.AA_img, axis=0)
-
+        # raw channels mean images are cached properties, only AA used for mask is calculated here
         # raw_mask = self.AA_mean_img > filters.threshold_otsu(self.AA_mean_img)
         self.raw_mask = masking.proc_mask(self.AA_mean_img, ext_fin_mask=True, proc_ext=30)
         self.narr_mask = masking.proc_mask(self.AA_mean_img)
@@ -396,97 +627,183 @@ class GReg():
         # self.filtered_mask = morphology.erosion(self.narr_mask, footprint=morphology.disk(10))
         # self.filtered_mask = morphology.dilation(self.filtered_mask, footprint=morphology.disk(5))
         # self.filtered_mask = ndi.binary_fill_holes(self.filtered_mask)
-        self.filtered_mask = morphology.opening(self.narr_mask, footprint=morphology.disk(10))
-        self.filtered_mask = morphology.erosion(self.filtered_mask, footprint=morphology.disk(10))
-        self.filtered_mask = morphology.opening(self.filtered_mask, footprint=morphology.disk(5))
+        # opening(disk 10) -> erosion(disk 10) -> opening(disk 5) with binary operations,
+        # border_value=1 keeps grayscale erosion behavior at the frame edges
+        disk_10, disk_5 = morphology.disk(10).astype(bool), morphology.disk(5).astype(bool)
+        self.filtered_mask = ndi.binary_erosion(self.narr_mask, structure=disk_10, border_value=1)
+        self.filtered_mask = ndi.binary_dilation(self.filtered_mask, structure=disk_10)
+        self.filtered_mask = ndi.binary_erosion(self.filtered_mask, structure=disk_10, border_value=1)
+        self.filtered_mask = ndi.binary_erosion(self.filtered_mask, structure=disk_5, border_value=1)
+        self.filtered_mask = ndi.binary_dilation(self.filtered_mask, structure=disk_5)
         # self.back_mask = morphology.dilation(self.filtered_mask, morphology.disk(3))
-        self.mask = self.filtered_mask  # morphology.erosion(self.filtered_mask, footprint=morphology.disk(2))
-        self.label = measure.label(self.mask)
+        # working mask, label and G image are set after channels processing, see set_mask
+
+        # pre and post float32 channels stacks [ch,t,x,y], channel images are views of them;
+        # AD isn't used for Fc and G, it's processed and stored only if store_AD=True
+        self.store_AD = store_AD
+        ch_idx = [0, 1, 2, 3] if self.store_AD else [0, 1, 3]
+
+        # one percentile scratch for pre and post stacks unless shared buffer provided
+        if bc_buf is None:
+            bc_buf = np.empty(max(self.img_raw.size, self.img_bleach.size) // self.img_raw.shape[-1] * len(ch_idx),
+                              dtype=np.result_type(self.img_raw, self.img_bleach))
+
+        self.channels = _bc_p_m(np.moveaxis(self.img_raw, -1, 0)[ch_idx], buf=bc_buf)
+        self.DD_img = self.channels[0]  # CFP-435  DD
+        self.DA_img = self.channels[1]  # YFP-435  DA
+        self.AD_img = self.channels[2] if self.store_AD else None  # CFP-505  AD
+        self.AA_img = self.channels[-1]  # YFP-505  AA
+
+        self.channels_post = _bc_p_m(np.moveaxis(self.img_bleach, -1, 0)[ch_idx], buf=bc_buf)
+        self.DD_img_post = self.channels_post[0]
+        self.DA_img_post = self.channels_post[1]
+        self.AD_img_post = self.channels_post[2] if self.store_AD else None
+        self.AA_img_post = self.channels_post[-1]
+
+        self.Fc_pre = self.__Fc_img(ch_img=self.channels,
+                                    a=self.a, b=self.b, c=self.c, d=self.d)
+        self.Fc_post = self.__Fc_img(ch_img=self.channels_post,
+                                     a=self.a, b=self.b, c=self.c, d=self.d)
 
-        bc_p_m = lambda x: np.array([f - np.percentile(f,1) for f in x]).clip(min=0).astype(np.uint16)
+        self._pp_fig = None  # persistent pre_post_plot figure
+        self.set_mask(self.filtered_mask)  # morphology.erosion(self.filtered_mask, footprint=morphology.disk(2))
 
-        self.DD_img = bc_p_m(self.DD_img)
-        self.DA_img = bc_p_m(self.DA_img)
-        self.AD_img = bc_p_m(self.AD_img)
-        self.AA_img = bc_p_m(self.AA_img)
 
-        self.DD_img_post = bc_p_m(self.DD_img_post)
-        self.DA_img_post = bc_p_m(self.DA_img_post)
-        self.AD_img_post = bc_p_m(self.AD_img_post)
-        self.AA_img_post = bc_p_m(self.AA_img_post)
+    def set_mask(self, mask):
+        """ Set working mask, rebuilds label, G image and all mask- and label-derived
+        reduction state, cached masked profiles are recalculated on next use.
+
+        """
+        self.mask = mask
+        self.label = measure.label(self.mask)
+        self.n_labels = int(np.max(self.label))
+        # masked pixels in flattened frame and their fraction, selects masked frame mean method
+        self._mask_idx = np.flatnonzero(self.mask)
+        self._mask_frac = self._mask_idx.size / self.mask.size
+        # flattened float32 mask scaled by masked pixels count, frame mean as dot product
+        self._mask_w = self.mask.ravel().astype(np.float32) / np.float32(max(self._mask_idx.size, 1))
+        # labeled pixels layout
+        self._label_px, self._label_idx = _label_px(self.label)
+        # drop mask-derived cached properties, recalculated on next use
+        for cache_name in ('_label_ind', '_chan_means'):
+            self.__dict__.pop(cache_name, None)
 
-        self.Fc_pre = self.__Fc_img(dd_img=self.DD_img,
-                                    da_img=self.DA_img,
-                                    aa_img=self.AA_img,
-                                    a=self.a, b=self.b, c=self.c, d=self.d)
-        self.Fc_post = self.__Fc_img(dd_img=self.DD_img_post,
-                                     da_img=self.DA_img_post, aa_img=self.AA_img_post,
-                                     a=self.a, b=self.b, c=self.c, d=self.d)
-        
         self.G_img = self.__G_img(Fc_pre_img=self.Fc_pre, Fc_post_img=self.Fc_post,
                                   dd_pre_img=self.DD_img, dd_post_img=self.DD_img_post,
                                   mask=self.mask)
 
 
+    @cached_property
+    def _label_ind(self):
+        """ Sparse label indicator matrix [px,label_num-1] of labeled pixels, rebuilt after `set_mask`
+
+        """
+        return _label_indicator(self._label_idx, self.n_labels)
+
+
+    # raw channels mean images, cached (see _ch_mean_imgs)
+    @cached_property
+    def DD_mean_img(self):
+        return np.mean(self.img_raw[...,0], axis=0, dtype=np.float32)
+
+    @cached_property
+    def DA_mean_img(self):
+        return np.mean(self.img_raw[...,1], axis=0, dtype=np.float32)
+
+    @cached_property
+    def AD_mean_img(self):
+        return np.mean(self.img_raw[...,2], axis=0, dtype=np.float32)
+
+    @cached_property
+    def AA_mean_img(self):
+        return np.mean(self.img_raw[...,3], axis=0, dtype=np.float32)
+
+
     @staticmethod
-    def __Fc_img(dd_img, da_img, aa_img, a, b, c, d):
-        Fc_img = []
-        for frame_num in range(dd_img.shape[0]):
-            DD_frame = dd_img[frame_num]
-            DA_frame = da_img[frame_num]
-            AA_frame = aa_img[frame_num]
-
-            Fc_frame = DA_frame - a*(AA_frame - c*DD_frame) - d*(DD_frame - b*AA_frame)
-            Fc_frame[Fc_frame < 0] = 0
-            Fc_img.append(Fc_frame)
-
-        return np.asarray(Fc_img)
+    def __Fc_img(ch_img, a, b, c, d):
+        # ch_img - channels stack [DD,DA,AD,AA] or [DD,DA,AA]
+        # DA - a*(AA - c*DD) - d*(DD - b*AA) collapsed to DD*(a*c - d) + AA*(b*d - a) + DA
+        Fc_img = np.multiply(ch_img[0], a*c - d, dtype=np.float32)
+        Fc_img += ch_img[-1] * np.float32(b*d - a)
+        Fc_img += ch_img[1]
+        np.maximum(Fc_img, 0, out=Fc_img)
+
+        return Fc_img
     
 
     @staticmethod
     def __G_img(Fc_pre_img, Fc_post_img, dd_pre_img, dd_post_img, mask):
-        G_img = []
-        for frame_num in range(Fc_pre_img.shape[0]):
-            Fc_pre_frame = ma.masked_where(~mask, Fc_pre_img[frame_num])
-            Fc_post_frame = ma.masked_where(~mask, Fc_post_img[frame_num])
-            DD_pre_frame = ma.masked_where(~mask, dd_pre_img[frame_num])
-            DD_post_frame = ma.masked_where(~mask, dd_post_img[frame_num])
-
-            G_frame = (Fc_pre_frame - Fc_post_frame) / (DD_post_frame - DD_pre_frame)
-            G_img.append(G_frame)
-        
-        return np.asarray(G_img)
-        
+        Fc_delta = Fc_pre_img - Fc_post_img
+        DD_delta = dd_post_img - dd_pre_img
 
-    def G_fit_frames(self, bad_rois):
-        # https://realpython.com/linear-regression-in-python/)
-        DD_delta_arr = np.asarray([])
-        Fc_delta_arr = np.asarray([])
-        
-        fig, ax = plt.subplots(layout="constrained", figsize=(10, 4))
-        fig.suptitle(f'{self.img_name}: G parameter estimation by frames')
+        # pixels outside the mask or with zero DD change are NaN
+        G_img = np.full(Fc_delta.shape, np.nan, dtype=np.float32)
+        np.divide(Fc_delta, DD_delta, out=G_img, where=mask[None,:,:] & (DD_delta != 0))
+
+        return G_img
         
-        for label_num in range(1, np.max(self.label)+1):
-            label_mask = self.label == label_num
 
-            DD_delta = np.mean(self.DD_img_post, axis=(1,2), where=label_mask) - \
-                       np.mean(self.DD_img, axis=(1,2), where=label_mask)
-            
-            Fc_delta = np.mean(self.Fc_pre, axis=(1,2), where=label_mask) - \
-                       np.mean(self.Fc_post, axis=(1,2), where=label_mask)
+    def _masked_frame_mean(self, img):
+        """ Masked area mean profile of [t,x,y] or [ch,t,x,y] stack.
+
+        Small masks (less than 25% of frame) are reduced from gathered masked pixels only,
+        larger ones by one matrix-vector product with weighted mask (BLAS GEMV)
+        for all channels and frames of the stack viewed as [ch*t,px] matrix.
+        Profile of empty mask is NaN.
+
+        """
+        if self._mask_idx.size == 0:
+            return np.full(img.shape[:-2], np.nan, dtype=np.float32)
+        flat_img = img.reshape(-1, img.shape[-2]*img.shape[-1])
+        if self._mask_frac < 0.25:
+            frame_mean = np.mean(flat_img[:,self._mask_idx], axis=-1)
+        else:
+            frame_mean = np.matmul(flat_img, self._mask_w)
+        return frame_mean.reshape(img.shape[:-2])
+
+
+    @cached_property
+    def _chan_means(self):
+        """ Masked area mean profiles of pre and post channels and Fc,
+        calculated on first use and rebuilt after `set_mask`.
+
+        Returns
+        -------
+        chan_mean_pre, chan_mean_post: dict
+            channel name ('DD', 'DA', 'AD' if stored, 'AA', 'Fc') - 1d profile
 
+        """
+        ch_names = ['DD', 'DA', 'AD', 'AA'] if self.store_AD else ['DD', 'DA', 'AA']
+        chan_mean_pre = dict(zip(ch_names, self._masked_frame_mean(self.channels)))
+        chan_mean_pre['Fc'] = self._masked_frame_mean(self.Fc_pre)
+        chan_mean_post = dict(zip(ch_names, self._masked_frame_mean(self.channels_post)))
+        chan_mean_post['Fc'] = self._masked_frame_mean(self.Fc_post)
+        return chan_mean_pre, chan_mean_post
 
 
-            if label_num in bad_rois:
-                ax.scatter(x=DD_delta,y=Fc_delta, label=label_num, alpha=.5, marker='x')
-            else:
-                ax.scatter(x=DD_delta,y=Fc_delta, label=label_num, alpha=.5)
+    def G_calc_frames(self, bad_rois=[]):
+        """ G parameter estimation by frames, fit of ROIs mean Fc decrease
+        vs. DD increase after acceptor photobleaching, `bad_rois` labels are skipped in the fit.
 
-                DD_delta_arr = np.concatenate((DD_delta_arr, DD_delta))
-                Fc_delta_arr = np.concatenate((Fc_delta_arr, Fc_delta))
+        Returns
+        -------
+        fit_dict: dict
+            DD (`x`) and Fc (`y`) deltas for all ROIs and frames, label number of each point (`label`),
+            mask of points used in the fit (`fit_mask`) and linear fit results
 
-        # slope, intercept, r, p, std_err = stats.linregress(DD_delta_arr, Fc_delta_arr)
-        # lin_mod = lambda x: slope*x + intercept
+        """
+        # https://realpython.com/linear-regression-in-python/)
+        # all stacks reduced for all labels and frames in one call, [stack, label_num-1, t]
+        px_stack = np.stack([_px_gather(img, self._label_px) for img in (self.DD_img_post, self.DD_img,
+                                                                        self.Fc_pre, self.Fc_post)])
+        DD_post_label, DD_label, Fc_pre_label, Fc_post_label = np.swapaxes(_label_mean_sd(px_stack, self._label_ind, calc_sd=False)[0], 1, 2)
+        DD_delta_label = DD_post_label - DD_label
+        Fc_delta_label = Fc_pre_label - Fc_post_label
+
+        label_arr = np.repeat(np.arange(1, self.n_labels+1), DD_delta_label.shape[1])
+        fit_mask = ~np.isin(label_arr, bad_rois)
+        DD_delta_arr = DD_delta_label.ravel()[fit_mask]
+        Fc_delta_arr = Fc_delta_label.ravel()[fit_mask]
 
         lin_mod_data = stats.linregress(DD_delta_arr, Fc_delta_arr)
         slope, p_slope, std_err_slope = lin_mod_data.slope, lin_mod_data.pvalue, lin_mod_data.stderr
@@ -496,61 +813,92 @@ class GReg():
         p_t_calc = lambda m,s,l: 2*stats.t.sf(abs(m/s), (1.0*l - 2))
         p_intercept = p_t_calc(intercept, std_err_intercept, len(DD_delta_arr))
 
-        lin_mod = lambda x: slope*x + intercept
+        return {'x':DD_delta_label.ravel(), 'y':Fc_delta_label.ravel(), 'label':label_arr, 'fit_mask':fit_mask,
+                'slope':slope, 'std_err_slope':std_err_slope, 'p_slope':p_slope,
+                'intercept':intercept, 'std_err_intercept':std_err_intercept, 'p_intercept':p_intercept,
+                'r':r}
 
 
-        ax.plot(DD_delta_arr, list(map(lin_mod, DD_delta_arr)),
+    def G_fit_frames(self, bad_rois, show=True):
+        fit_dict = self.G_calc_frames(bad_rois=bad_rois)
+        slope, intercept = fit_dict['slope'], fit_dict['intercept']
+        fit_mask = fit_dict['fit_mask']
+
+        fig, ax = plt.subplots(layout="constrained", figsize=(10, 4))
+        fig.suptitle(f'{self.img_name}: G parameter estimation by frames')
+
+        # fitted and bad ROIs in two scatters, colored by label number
+        color_kw = _label_color_kw(self.n_labels)
+        fit_sc = ax.scatter(x=fit_dict['x'][fit_mask], y=fit_dict['y'][fit_mask],
+                            c=fit_dict['label'][fit_mask], alpha=.5, **color_kw)
+        handles, labels = fit_sc.legend_elements(num=None)
+        if not np.all(fit_mask):
+            bad_sc = ax.scatter(x=fit_dict['x'][~fit_mask], y=fit_dict['y'][~fit_mask],
+                                c=fit_dict['label'][~fit_mask], alpha=.5, marker='x', **color_kw)
+            bad_handles, bad_labels = bad_sc.legend_elements(num=None)
+            handles, labels = handles + bad_handles, labels + bad_labels
+
+        # straight line, end points only
+        line_x = np.array([np.min(fit_dict['x'][fit_mask]), np.max(fit_dict['x'][fit_mask])])
+        ax.plot(line_x, slope*line_x + intercept,
                  color='k', linestyle='--')
-        ax.set_title(f'G={round(slope,3)}+/-{round(std_err_slope,3)} (p={round(p_slope,4)}), inter.={round(intercept,1)}+/-{round(std_err_slope,3)} (p={round(p_intercept,4)}), R^2={round(r,4)}')
+        ax.set_title(f'G={round(slope,3)}+/-{round(fit_dict["std_err_slope"],3)} (p={round(fit_dict["p_slope"],4)}), inter.={round(intercept,1)}+/-{round(fit_dict["std_err_intercept"],3)} (p={round(fit_dict["p_intercept"],4)}), R^2={round(fit_dict["r"],4)}')
         ax.set_xlabel('Δ DD, a.u.')
         ax.set_ylabel('Δ Fc, a.u.')
-        ax.legend()
+        ax.legend(handles, labels)
 
-        plt.show()
+        if show:
+            plt.show()
 
 
-    def G_fit_px(self, frame_num=0, bad_rois=[]):
-        DD_delta_frame_arr = np.asarray([])
-        Fc_delta_frame_arr = np.asarray([])
-        
-        fig, ax = plt.subplots(layout="constrained", figsize=(10, 4))
-        fig.suptitle(f'{self.img_name}: G parameter estimation pixel-wise (frame {frame_num})')
-        
+    def G_calc_px(self, frame_num=0, bad_rois=[]):
+        """ Pixel-wise G parameter estimation for selected frame,
+        pixels without DD increase or Fc decrease and `bad_rois` labels are skipped.
+
+        Returns
+        -------
+        fit_dict: dict
+            DD (`x`) and Fc (`y`) deltas of fitted pixels,
+            label number of each pixel (`label`) and linear fit results
+
+        """
         DD_delta_frame = self.DD_img_post[frame_num] - np.minimum(self.DD_img[frame_num], self.DD_img_post[frame_num])  
         Fc_delta_frame = self.Fc_pre[frame_num] - np.minimum(self.Fc_post[frame_num], self.Fc_pre[frame_num]) 
-        for label_num in range(1, np.max(self.label)+1):
-            label_mask = self.label == label_num
+        keep_px, keep_label = _label_keep_px(self.label, self.n_labels, bad_rois)
+        DD_delta_arr = DD_delta_frame.ravel()[keep_px]
+        Fc_delta_arr = Fc_delta_frame.ravel()[keep_px]
 
-            DD_delta = ma.masked_where(label_mask, DD_delta_frame).compressed()
-            Fc_delta = ma.masked_where(label_mask, Fc_delta_frame).compressed()
+        delta_non_zeros = (DD_delta_arr > 0) & (Fc_delta_arr > 0)
+        DD_delta_arr, Fc_delta_arr = DD_delta_arr[delta_non_zeros], Fc_delta_arr[delta_non_zeros]
+        label_arr = keep_label[delta_non_zeros]
 
-            delta_zeros = np.array([any(t) for t in zip(DD_delta<=0, Fc_delta<=0)], dtype=np.bool_)
-            DD_delta, Fc_delta = DD_delta[~delta_zeros], Fc_delta[~delta_zeros]
+        slope, intercept, r, p_slope, std_err_slope, std_err_intercept = _lin_fit(DD_delta_arr, Fc_delta_arr)
 
-            if label_num in bad_rois:
-                continue
-            else:
-                ax.scatter(x=DD_delta,y=Fc_delta, label=label_num,
-                           alpha=.1, s=0.075)
+        p_t_calc = lambda m,s,l: 2*stats.t.sf(abs(m/s), (1.0*l - 2))
+        p_intercept = p_t_calc(intercept, std_err_intercept, len(DD_delta_arr))
 
-                DD_delta_arr = np.concatenate((DD_delta_frame_arr, DD_delta))
-                Fc_delta_arr = np.concatenate((Fc_delta_frame_arr, Fc_delta))
+        return {'x':DD_delta_arr, 'y':Fc_delta_arr, 'label':label_arr,
+                'slope':slope, 'std_err_slope':std_err_slope, 'p_slope':p_slope,
+                'intercept':intercept, 'std_err_intercept':std_err_intercept, 'p_intercept':p_intercept,
+                'r':r}
 
-        # slope, intercept, r, p_slope, std_err = stats.linregress(DD_delta_arr, Fc_delta_arr)
 
-        lin_mod_data = stats.linregress(DD_delta_arr, Fc_delta_arr)
-        slope, p_slope, std_err_slope = lin_mod_data.slope, lin_mod_data.pvalue, lin_mod_data.stderr
-        intercept, std_err_intercept = lin_mod_data.intercept, lin_mod_data.intercept_stderr
-        r = lin_mod_data.rvalue
+    def G_fit_px(self, frame_num=0, bad_rois=[]):
+        fit_dict = self.G_calc_px(frame_num=frame_num, bad_rois=bad_rois)
+        slope, intercept = fit_dict['slope'], fit_dict['intercept']
 
-        p_t_calc = lambda m,s,l: 2*stats.t.sf(abs(m/s), (1.0*l - 2))
-        p_intercept = p_t_calc(intercept, std_err_intercept, len(DD_delta_arr))
+        fig, ax = plt.subplots(layout="constrained", figsize=(10, 4))
+        fig.suptitle(f'{self.img_name}: G parameter estimation pixel-wise (frame {frame_num})')
 
-        lin_mod = lambda x: slope*x + intercept
+        # all labels in one scatter, colored by label number
+        ax.scatter(x=fit_dict['x'], y=fit_dict['y'], c=fit_dict['label'],
+                   alpha=.1, s=0.075, **_label_color_kw(self.n_labels))
 
-        ax.plot(DD_delta_arr, list(map(lin_mod, DD_delta_arr)),
+        # straight line, end points only
+        line_x = np.array([np.min(fit_dict['x']), np.max(fit_dict['x'])], dtype=float)
+        ax.plot(line_x, slope*line_x + intercept,
                  color='k', linestyle='--')
-        ax.set_title(f'G={round(slope,3)}+/-{round(std_err_slope,3)} (p={round(p_slope,4)}), inter.={round(intercept,1)}+/-{round(std_err_slope,3)} (p={round(p_intercept,4)}), R^2={round(r,4)}')
+        ax.set_title(f'G={round(slope,3)}+/-{round(fit_dict["std_err_slope"],3)} (p={round(fit_dict["p_slope"],4)}), inter.={round(intercept,1)}+/-{round(fit_dict["std_err_intercept"],3)} (p={round(fit_dict["p_intercept"],4)}), R^2={round(fit_dict["r"],4)}')
         ax.set_xlabel('Δ DD, a.u.')
         ax.set_ylabel('Δ Fc, a.u.')
         plt.show()
@@ -562,7 +910,10 @@ class GReg():
         elif sel_img == 'Fc_post':
             img_mean = np.mean(self.Fc_post, axis=0)
         elif sel_img == 'G':
-            img_mean = np.mean(self.G_img, axis=0)
+            # G is NaN outside the mask and where DD doesn't change, all-NaN pixels stay NaN
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                img_mean = np.nanmean(self.G_img, axis=0)
         elif sel_img == 'AA':
             img_mean = np.mean(self.AA_img, axis=0)
 
@@ -585,18 +936,20 @@ class GReg():
         plt.show()    
 
 
-    def prof_plot(self):
+    def prof_plot(self, show=True):
+        mean_pre, mean_post = self._chan_means
+
         plt.figure(figsize=(10,5))
 
         ax0 = plt.subplot()
-        ax0.plot(np.mean(self.DD_img, axis=(1,2), where=self.mask),
+        ax0.plot(mean_pre['DD'],
                  label='DD', color='r', marker='.')
-        ax0.plot(np.mean(self.DD_img_post, axis=(1,2), where=self.mask),
+        ax0.plot(mean_post['DD'],
                  label='DD post', color='r', linestyle='--', marker='.')
 
-        ax0.plot(np.mean(self.DA_img, axis=(1,2), where=self.mask),
+        ax0.plot(mean_pre['DA'],
                  label='DA', color='g', marker='.')
-        ax0.plot(np.mean(self.DA_img_post, axis=(1,2), where=self.mask),
+        ax0.plot(mean_post['DA'],
                  label='DA post', color='g', linestyle='--', marker='.')
 
         # ax0.plot(np.mean(self.AD_img, axis=(1,2), where=self.mask),
@@ -604,14 +957,14 @@ class GReg():
         # ax0.plot(np.mean(self.AD_img_post, axis=(1,2), where=self.mask),
         #          label='AD post', color='y', linestyle='--', marker='.')
 
-        ax0.plot(np.mean(self.AA_img, axis=(1,2), where=self.mask),
+        ax0.plot(mean_pre['AA'],
                  label='AA', color='b', marker='.')
-        ax0.plot(np.mean(self.AA_img_post, axis=(1,2), where=self.mask),
+        ax0.plot(mean_post['AA'],
                  label='AA post', color='b', linestyle='--', marker='.')
 
-        ax0.plot(np.mean(self.Fc_pre, axis=(1,2), where=self.mask),
+        ax0.plot(mean_pre['Fc'],
                  label='Fc', color='m', marker='.')
-        ax0.plot(np.mean(self.Fc_post, axis=(1,2), where=self.mask),
+        ax0.plot(mean_post['Fc'],
                  label='Fc post', color='m', linestyle='--', marker='.')
 
         ax0.set_xlabel('Frame num')
@@ -619,7 +972,8 @@ class GReg():
         ax0.legend()
         plt.suptitle(f'{self.img_name} profiles')
         plt.tight_layout()
-        plt.show()
+        if show:
+            plt.show()
 
 
     # def Fc_DD_pic(self):
@@ -711,112 +1065,91 @@ class GReg():
     #     plt.show()
 
 
-    def pre_post_plot(self):
-        plt.figure(figsize=(10,5))
+    def pre_post_plot(self, show=True):
+        mean_pre, mean_post = self._chan_means
+
+        # figure and lines are created on first call, next calls only update lines data while figure is open
+        if self._pp_fig is None or not plt.fignum_exists(self._pp_fig.number):
+            self._pp_fig = plt.figure(figsize=(10,5))
+            self._pp_lines = {}
+            ch_list = [('DD', 'DD (Ch.0)', 'r', 221),
+                       ('DA', 'DA (Ch.1)', 'g', 222),
+                       ('AD', 'AD (Ch.2)', 'y', 223),
+                       ('AA', 'AA (Ch.3)', 'b', 224)]
+            for ch, ch_title, ch_color, ch_subplot in ch_list:
+                ax = plt.subplot(ch_subplot)
+                ax.set_title(ch_title)
+                if ch not in mean_pre:
+                    ax.text(0.5, 0.5, 'not stored (store_AD=False)', ha='center', va='center')
+                    ax.axis('off')
+                    continue
+                self._pp_lines[f'{ch}_pre'], = ax.plot(mean_pre[ch],
+                                                       label='pre', color=ch_color, marker='.')
+                self._pp_lines[f'{ch}_post'], = ax.plot(mean_post[ch],
+                                                        label='post', color=ch_color, linestyle='--', marker='.')
+                ax.legend()
+
+            plt.suptitle(f'Registration {self.img_name}')
+            plt.tight_layout()
+        else:
+            for ch in self._pp_lines.keys():
+                ch_name, ch_state = ch.split('_')
+                ch_line = self._pp_lines[ch]
+                ch_line.set_ydata(mean_pre[ch_name] if ch_state == 'pre' else mean_post[ch_name])
+                ch_line.axes.relim()
+                ch_line.axes.autoscale_view()
+            self._pp_fig.canvas.draw_idle()
+        if show:
+            plt.show()
 
-        ax0 = plt.subplot(221)
-        ax0.set_title('DD (Ch.0)')
-        ax0.plot(np.mean(self.DD_img, axis=(1,2), where=self.mask),
-                 label='pre', color='r', marker='.')
-        ax0.plot(np.mean(self.DD_img_post, axis=(1,2), where=self.mask),
-                 label='post', color='r', linestyle='--', marker='.')
-        ax0.legend()
 
-        ax1 = plt.subplot(222)
-        ax1.set_title('DA (Ch.1)')
-        ax1.plot(np.mean(self.DA_img, axis=(1,2), where=self.mask),
-                 label='pre', color='g', marker='.')
-        ax1.plot(np.mean(self.DA_img_post, axis=(1,2), where=self.mask),
-                 label='post', color='g', linestyle='--', marker='.')
-        ax1.legend()
-
-        ax2 = plt.subplot(223)
-        ax2.set_title('AD (Ch.2)')
-        ax2.plot(np.mean(self.AD_img, axis=(1,2), where=self.mask),
-                 label='pre', color='y', marker='.')
-        ax2.plot(np.mean(self.AD_img_post, axis=(1,2), where=self.mask),
-                 label='post', color='y', linestyle='--', marker='.')
-        ax2.legend()
-
-        ax3 = plt.subplot(224)
-        ax3.set_title('AA (Ch.3)')
-        ax3.plot(np.mean(self.AA_img, axis=(1,2), where=self.mask),
-                 label='pre', color='b', marker='.')
-        ax3.plot(np.mean(self.AA_img_post, axis=(1,2), where=self.mask),
-                 label='post', color='b', linestyle='--', marker='.')
-        ax3.legend()
-        
+    def ch_pic(self):
+        # shared color scale from the plotted mean images, not from full raw stack
+        mean_imgs = _ch_mean_imgs(self)
+        int_min, int_max = np.min(mean_imgs), np.max(mean_imgs)
+
+        fig = plt.figure(figsize=(10,10))
+        # 2x2 grid of channels mean images with one shared colorbar
+        grid = ImageGrid(fig, 111, nrows_ncols=(2,2), axes_pad=0.4,
+                         cbar_mode='single', cbar_location='right', cbar_size='3%', cbar_pad=0.1)
+        ch_titles = ['DD (Ch.0)', 'DA (Ch.1)', 'AD (Ch.2)', 'AA (Ch.3)']
+        for ax, ch_title, ch_mean_img in zip(grid, ch_titles, mean_imgs):
+            ax.set_title(ch_title)
+            ch_img = ax.imshow(ch_mean_img, cmap='jet', interpolation='nearest',
+                               vmin=int_min, vmax=int_max)
+            ax.axis('off')
+        grid.cbar_axes[0].colorbar(ch_img)
+
         plt.suptitle(f'Registration {self.img_name}')
-        plt.tight_layout()
         plt.show()
 
 
-    def ch_pic(self):
-        int_min = np.min(self.img_raw)
-        int_max = np.max(self.img_raw)
-
-
-        plt.figure(figsize=(10,10))
+    def _G_label_prof(self):
+        """ G mean and SD profiles of each label element, all labels and frames
+        from sparse matrix products with cached label indicator.
 
-        ax0 = plt.subplot(221)
-        ax0.set_title('DD (Ch.0)')
-        img0 = ax0.imshow(self.DD_mean_img, cmap='jet')
-        img0.set_clim(vmin=int_min, vmax=int_max)
-        div0 = make_axes_locatable(ax0)
-        cax0 = div0.append_axes('right', size='3%', pad=0.1)
-        plt.colorbar(img0, cax=cax0)
-        ax0.axis('off')
+        Returns two ndarrays [t,label_num-1]
 
-        ax1 = plt.subplot(222)
-        ax1.set_title('DA (Ch.1)')
-        img1 = ax1.imshow(self.DA_mean_img, cmap='jet')
-        img1.set_clim(vmin=int_min, vmax=int_max)
-        div1 = make_axes_locatable(ax1)
-        cax1 = div1.append_axes('right', size='3%', pad=0.1)
-        plt.colorbar(img1, cax=cax1)
-        ax1.axis('off')
-
-        ax2 = plt.subplot(223)
-        ax2.set_title('AD (Ch.2)')
-        img2 = ax2.imshow(self.AD_mean_img, cmap='jet')
-        img2.set_clim(vmin=int_min, vmax=int_max)
-        div2 = make_axes_locatable(ax2)
-        cax2 = div2.append_axes('right', size='3%', pad=0.1)
-        plt.colorbar(img2, cax=cax2)
-        ax2.axis('off')
-
-        ax3 = plt.subplot(224)
-        ax3.set_title('AA (Ch.3)')
-        img3 = ax3.imshow(self.AA_mean_img, cmap='jet')
-        img3.set_clim(vmin=int_min, vmax=int_max)
-        div3 = make_axes_locatable(ax3)
-        cax3 = div3.append_axes('right', size='3%', pad=0.1)
-        plt.colorbar(img3, cax=cax3)
-        ax3.axis('off')
+        """
+        return _label_mean_sd(_px_gather(self.G_img, self._label_px), self._label_ind)
 
-        plt.suptitle(f'Registration {self.img_name}')
-        plt.tight_layout()
-        plt.show()
 
+    def G_plot_by_label(self, show=True):
+        label_prof_mean, label_prof_sd = self._G_label_prof()
 
-    def G_plot_by_label(self):
         plt.figure(figsize=(10,4))
-        for label_num in range(1, np.max(self.label)+1):
-            label_mask = self.label == label_num
-
-            label_prof_mean = np.mean(self.G_img, axis=(1,2), where=label_mask)
-            label_prof_sd = np.std(self.G_img, axis=(1,2), where=label_mask)
-
-            plt.errorbar(list(range(label_prof_mean.shape[0])), label_prof_mean,
-                        yerr = label_prof_sd,
+        for label_num in range(1, self.n_labels+1):
+            plt.errorbar(list(range(label_prof_mean.shape[0])), label_prof_mean[:,label_num-1],
+                        yerr = label_prof_sd[:,label_num-1],
                         fmt ='-o', capsize=2, label=label_num, alpha=.75)
-            plt.hlines(y=np.median(label_prof_mean),
+            plt.hlines(y=np.nanmedian(label_prof_mean[:,label_num-1]),
                                 xmin=0, xmax=label_prof_mean.shape[0],
                                 linestyles='--')
 
         plt.legend()
         plt.tight_layout()
-        plt.show()
+        if show:
+            plt.show()
 
 
     def G_report_pic(self):
@@ -829,18 +1162,15 @@ class GRegSet():
                 reg_params = tandem_reg_dict[reg_name]
                 raw_path = data_path + f'{reg_params[0]}.tif'
                 bleach_path = data_path + f'{reg_params[1]}.tif'
+                # kwargs are passed to GReg, coef_list is required
                 self.tandem_reg_list.append(GReg(img_name=reg_name,
-                                                 raw_path=raw_path,
-                                                 bleach_path=bleach_path,
-                                                 bleach_frame=reg_params[2],
-                                                 bleach_exp=reg_params[3],
-                                                 A_exp=reg_params[4],
-                                                 D_exp=reg_params[5],
+                                                 pre_img=_load_reg_img(raw_path),
+                                                 post_img=_load_reg_img(bleach_path),
                                                  **kwargs))
 
 
         def G_calc(self, bad_label:list[int,...]):
-            self.G_df =  self.get_G(reg_list=self.tandem_reg_list)
+            self.G_df =  self.get_G(reg_list=self.tandem_reg_list, bad_rois=bad_label)
 
 
         def G_fit_pic(self):
@@ -848,35 +1178,84 @@ class GRegSet():
                 reg.Fc_DD_pic()
 
         def G_calc_fit(self, **kwargs):
-            for reg in self.tandem_reg_list:
-                reg.G_calc_fit(**kwargs)
+            """ Frames G fit of all registrations, kwargs are passed to `GReg.G_calc_frames`.
+
+            Fit results are stored in `G_fit_dict` by registration name.
+
+            """
+            self.G_fit_dict = {reg.img_name:reg.G_calc_frames(**kwargs) for reg in self.tandem_reg_list}
 
 
         @ staticmethod
-        def get_G(reg_list):
-            """ Create data frame with calculated crosstalc coeficients for each calibration registration
+        def get_G(reg_list, bad_rois=[]):
+            """ Create data frame with G parameter estimated by frames fit for each registration,
+            `bad_rois` labels are skipped in the fit.
 
-            """
-            G_df = pd.DataFrame(columns=['ID',
-                                         'A_exp',
-                                         'D_exp',
-                                         'val',
-                                         'sd'])
+            `val` - fit slope (G), `sd` - slope standard error
 
+            """
+            G_rows = []
             for reg in reg_list:
-                reg.G_calc_frame()
-                G_df = pd.concat([G_df, reg.G_df], ignore_index=True)
+                fit_dict = reg.G_calc_frames(bad_rois=bad_rois)
+                G_rows.append({'ID':reg.img_name,
+                               'val':fit_dict['slope'],
+                               'sd':fit_dict['std_err_slope'],
+                               'intercept':fit_dict['intercept'],
+                               'r':fit_dict['r']})
 
-            return G_df
+            return pd.DataFrame(G_rows, columns=['ID', 'val', 'sd', 'intercept', 'r'])
 
 
-        def draw_pic(self):
-            """ Return selected plotting methods results
-            Requires previous execution of 'get_G'
-            
+        def draw_pic(self, headless=False, save_path='', save_png=False, bad_rois=[]):
+            """ Return selected plotting methods results,
+            G frames fit plots skip `bad_rois` labels
+
+            With `headless=True` interactive plotting is skipped, masked channels and Fc profiles
+            and G profiles by labels of each registration are saved to `save_path` as
+            '<reg name>_prof.npz' and, if `save_png=True`, rendered to '<reg name>_prof.png'.
+
             """
+            if not headless:
+                # figures are drawn without interactive updates and shown once at the end
+                was_interactive = plt.isinteractive()
+                plt.ioff()
+                for reg in self.tandem_reg_list:
+                    reg.prof_plot(show=False)
+                    reg.pre_post_plot(show=False)
+                    reg.G_fit_frames(bad_rois=bad_rois, show=False)
+                    reg.G_plot_by_label(show=False)
+                plt.show()
+                if was_interactive:
+                    plt.ion()
+                return
+
+            # one figure outside of pyplot reused for all registrations, rendered by Agg on save
+            fig = Figure(figsize=(10,8)) if save_png else None
+            prof_colors = {'DD':'r', 'DA':'g', 'AD':'y', 'AA':'b', 'Fc':'m'}
             for reg in self.tandem_reg_list:
-                reg.Fc_plot()
-                reg.pre_post_plot()
-                reg.G_plot()
-                reg.G_plot_by_label()
\ No newline at end of file
+                mean_pre, mean_post = reg._chan_means
+                label_prof_mean, label_prof_sd = reg._G_label_prof()
+                np.savez(save_path + f'{reg.img_name}_prof.npz',
+                         **{f'{ch}_pre':ch_prof for ch, ch_prof in mean_pre.items()},
+                         **{f'{ch}_post':ch_prof for ch, ch_prof in mean_post.items()},
+                         G_label_mean=label_prof_mean, G_label_sd=label_prof_sd)
+                if not save_png:
+                    continue
+
+                fig.clf()
+                ax0, ax1 = fig.subplots(2, 1)
+                for ch in mean_pre.keys():
+                    ax0.plot(mean_pre[ch], label=ch, color=prof_colors[ch], marker='.')
+                    ax0.plot(mean_post[ch], label=f'{ch} post', color=prof_colors[ch], linestyle='--', marker='.')
+                ax0.set_ylabel('I, a.u.')
+                ax0.legend()
+                for label_num in range(1, reg.n_labels+1):
+                    ax1.errorbar(list(range(label_prof_mean.shape[0])), label_prof_mean[:,label_num-1],
+                                 yerr=label_prof_sd[:,label_num-1],
+                                 fmt='-o', capsize=2, label=label_num, alpha=.75)
+                ax1.set_xlabel('Frame num')
+                ax1.set_ylabel('G')
+                ax1.legend()
+                fig.suptitle(f'Registration {reg.img_name}')
+                fig.tight_layout()
+                fig.savefig(save_path + f'{reg.img_name}_prof.png', dpi=90)
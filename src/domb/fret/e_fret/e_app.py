@@ -1,3 +1,5 @@
+import warnings
+
 import numpy as np
 from numpy import ma
 import pandas as pd
@@ -27,6 +29,17 @@ from scipy import ndimage as ndi
 from ...utils import masking
 
 
+def _c_contiguous(img:np.ndarray, img_name:str):
+    """ C-contiguous image time series, strided views (e.g. channels of [t,x,y,ch] stack)
+    are copied with warning so upstream layout can be fixed.
+
+    """
+    if img.flags['C_CONTIGUOUS']:
+        return img
+    warnings.warn(f'{img_name} is not C-contiguous, copied for frame-wise processing', stacklevel=3)
+    return np.ascontiguousarray(img)
+
+
 class Eapp():
     def __init__(self, dd_img:np.ndarray, da_img:np.ndarray, aa_img:np.ndarray,  # ad_img:np.ndarray,
                  abcd_list:list, G_val:float,
@@ -83,10 +96,10 @@ class Eapp():
             image time series of E-FRET corrected for photobleaching
 
         """
-        self.DD_img = dd_img  # 435-CFP  DD
-        self.DA_img = da_img  # 435-YFP  DA
-        # self.AD_img = ad_img  # 505-CFP  AD
-        self.AA_img = aa_img  # 505-YFP  AA
+        self.DD_img = _c_contiguous(dd_img, 'dd_img')  # 435-CFP  DD
+        self.DA_img = _c_contiguous(da_img, 'da_img')  # 435-YFP  DA
+        # self.AD_img = _c_contiguous(ad_img, 'ad_img')  # 505-CFP  AD
+        self.AA_img = _c_contiguous(aa_img, 'aa_img')  # 505-YFP  AA
 
         self.a = abcd_list[0]
         self.b = abcd_list[1]
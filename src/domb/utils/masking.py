@@ -301,21 +301,15 @@ def label_prof_arr(input_label: np.ndarray, input_img_series: np.ndarray,
         intensity profiles for each label elements
  
     """
-    output_dict = {}
-    prof_arr = []
-    prof_df_arr=[]
-    for label_num in np.unique(input_label)[1:]:
-        region_mask = input_label == label_num
-        prof = np.mean(input_img_series, axis=(1,2), where=region_mask)
-        F_0 = np.mean(prof[:f0_win])
-        df_prof = (prof-F_0)/F_0
-        output_dict.update({label_num:[prof, df_prof]})
+    # all label elements are averaged in one labeled pass per frame
+    label_list = np.unique(input_label)[1:]
+    prof_arr = np.asarray([ndi.mean(frame, labels=input_label, index=label_list)
+                           for frame in input_img_series]).T
 
-        prof_arr.append(prof)
-        prof_df_arr.append(df_prof)
-        
+    F_0 = np.mean(prof_arr[:,:f0_win], axis=1, keepdims=True)
+    prof_df_arr = (prof_arr-F_0)/F_0
     
-    return np.asarray(prof_df_arr), np.asarray(prof_arr)
+    return prof_df_arr, prof_arr
 
 
 def trans_prof_arr(input_total_mask: np.ndarray,